@@ -1,7 +1,17 @@
+import asyncio
 import base64
+import contextlib
+import functools
 import io
+import logging
+import mimetypes
 import os
+import secrets
+import stat
+import traceback
 import uuid
+import httpx
+import pybase64
 from minio import Minio
 from mcp.server.fastmcp import FastMCP
 from dotenv import load_dotenv
@@ -20,7 +30,7 @@ mcp = FastMCP(
     2. upload_file - Upload a local file from the filesystem to MinIO and get a public URL
     3. upload_from_url - Download a file from URL and upload to MinIO (mirror/backup remote files)
     4. list_files - List all files in the MinIO bucket
-    5. generate_random_string - Generate a random UUID-based string (useful for unique filenames)
+    5. generate_random_string - Generate a random hexadecimal string (useful for unique filenames)
     
     Common use cases:
     - Save Playwright/browser screenshots to permanent storage (use upload_image)
@@ -50,23 +60,147 @@ MINIO_SECRET_KEY = get_required_env("MINIO_SECRET_KEY")
 PUBLIC_BASE_URL = get_required_env("PUBLIC_BASE_URL")
 
 BUCKET = os.getenv("MINIO_BUCKET", "images")
+# 公开访问 URL 的公共前缀，拼接对象名即为完整 URL
+_URL_PREFIX = f"{PUBLIC_BASE_URL.rstrip('/')}/{BUCKET}/"
 MINIO_SECURE = os.getenv("MINIO_SECURE", "false") == "true"
+# 指定 region 后 SDK 不再需要额外请求查询 bucket 所在 region
+MINIO_REGION = os.getenv("MINIO_REGION") or None
+# 开启后错误信息中附带完整的 traceback
+MCP_DEBUG = os.getenv("MCP_DEBUG", "false") == "true"
 
 client = Minio(
     MINIO_ENDPOINT,
     access_key=MINIO_ACCESS_KEY,
     secret_key=MINIO_SECRET_KEY,
-    secure=MINIO_SECURE
+    secure=MINIO_SECURE,
+    region=MINIO_REGION
 )
 
-# 确保 bucket 存在
+# 确保 bucket 存在（同时会缓存 bucket 的 region，后续上传不再重复查询）
 if not client.bucket_exists(BUCKET):
     client.make_bucket(BUCKET)
 
+# ===== HTTP 客户端初始化 =====
+# 通过 HTTP/1.1 keep-alive 连接池复用 TCP/TLS 连接，避免每次下载都重新握手
+# 不启用 HTTP/2：响应体按分片突发读取，同一连接上未读取的流会占满连接窗口，阻塞同源的其他下载
+# 使用 identity 编码，保证原始响应体就是文件内容，且与 Content-Length 一致
+_http = httpx.AsyncClient(
+    timeout=30,
+    follow_redirects=True,
+    headers={
+        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) MinIO-MCP/1.0',
+        'Accept-Encoding': 'identity',
+    }
+)
+# httpx 在 INFO 级别记录完整请求 URL，可能包含预签名 token 等敏感参数
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+class _StreamReader:
+    """
+    把异步字节块迭代器包装成 put_object 需要的同步 read() 接口。
+    
+    read() 在工作线程中调用，每个数据块都交回事件循环去下载。
+    """
+
+    def __init__(self, chunks, loop: asyncio.AbstractEventLoop):
+        self._chunks = chunks.__aiter__()
+        self._loop = loop
+        self._buffer = bytearray()
+        # 已被 read() 读出的字节数
+        self.bytes_read = 0
+
+    async def _next_chunk(self):
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    async def has_data(self) -> bool:
+        """在事件循环中预读数据（至少尝试读取 1 字节），不消耗数据，返回是否有数据"""
+        while not self._buffer:
+            chunk = await self._next_chunk()
+            if chunk is None:
+                break
+            self._buffer += chunk
+        return bool(self._buffer)
+
+    def _fill(self, size: int) -> None:
+        while size < 0 or len(self._buffer) < size:
+            chunk = asyncio.run_coroutine_threadsafe(self._next_chunk(), self._loop).result()
+            if chunk is None:
+                break
+            self._buffer += chunk
+
+    def read(self, size: int = -1) -> bytes:
+        self._fill(size)
+        if size < 0 or size > len(self._buffer):
+            size = len(self._buffer)
+        # 通过 memoryview 切片只复制一次，避免先切出临时 bytearray
+        with memoryview(self._buffer) as view:
+            data = bytes(view[:size])
+        del self._buffer[:size]
+        self.bytes_read += len(data)
+        return data
+
+
+# base64 数据中需要去除的空白字符
+_WS_TRANS = str.maketrans("", "", " \t\n\r\x0b\x0c")
+
+# 删除 base64 字母表中的所有字符，剩下的即为非法字符
+_B64_ALPHABET_TRANS = str.maketrans(
+    "", "", "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
+)
+
+
+def _looks_like_base64(data: str, n: int = 256) -> bool:
+    """只检查前 n 个字符是否都属于 base64 字母表，用于在解码前快速拒绝非法数据"""
+    return not data[:n].translate(_B64_ALPHABET_TRANS)
+
+
+# 常见图片格式的文件头
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_JPEG_SIGNATURE = b"\xff\xd8\xff"
+
+# 小于该长度的 base64 数据使用标准库解码，SIMD 解码的调度开销在小数据上得不偿失
+_PYBASE64_MIN_LENGTH = 1024
+
+# 启动时加载系统 MIME 类型数据库，避免在首次工具调用时加载
+mimetypes.init()
+
+
+@functools.lru_cache(maxsize=256)
+def _guess_content_type(ext: str) -> str:
+    """根据小写扩展名（如 ".png"）推断 MIME 类型，结果会被缓存"""
+    return mimetypes.types_map.get(ext, "application/octet-stream")
+
+
+# ===== 分片上传参数 =====
+# MinIO 分片过多时吞吐量下降明显，按文件大小计算分片，使分片数量控制在约 200 个以内
+#
+# 内存占用：分片会完整驻留在内存中（_StreamReader 的缓冲区 + read() 返回的 bytes），
+# 每个 upload_from_url 调用的峰值约为 2 × 分片大小。
+# 长度未知时 SDK 每次多读 1 字节再拼接、切片，峰值约为 4 × 分片大小。
+_MIN_PART_SIZE = 16 * 1024 * 1024
+# 单个分片的上限，即已知长度时每个上传峰值约 256 MiB（超过 1.25 TiB 的文件为满足分片数量上限会超过该值）
+_MAX_PART_SIZE = 128 * 1024 * 1024
+_TARGET_PART_COUNT = 200
+# S3 协议限制的最大分片数量
+_MAX_PART_COUNT = 10000
+# 长度未知时使用的分片大小，每个上传峰值约 256 MiB
+_UNKNOWN_LENGTH_PART_SIZE = 64 * 1024 * 1024
+
+
+def _part_size_for(length: int) -> int:
+    """根据对象大小计算分片大小"""
+    part_size = min(max(_MIN_PART_SIZE, -(-length // _TARGET_PART_COUNT)), _MAX_PART_SIZE)
+    # 超大文件时保证分片数量不超过协议上限
+    return max(part_size, -(-length // _MAX_PART_COUNT))
+
 
 # ===== MCP Tool 定义 =====
 @mcp.tool()
-def upload_image(
+async def upload_image(
     base64_data: str,
     filename: str = None,
     content_type: str = "image/png"
@@ -88,6 +222,7 @@ def upload_image(
                   If not provided, auto-generates UUID name.
         content_type: Image MIME type, default "image/png".
                       Use "image/jpeg" for JPEG images.
+                      PNG and JPEG data are detected automatically.
     
     Returns:
         Success message with the public URL, or error message.
@@ -100,61 +235,78 @@ def upload_image(
     try:
         # 处理 base64 数据
         # 1. 去除可能存在的 data URI 前缀 (data:image/png;base64,)
+        #    前缀只会出现在开头，只在前 256 个字符内查找逗号，避免扫描整个字符串
         data = base64_data.strip()
-        if "," in data:
-            # 分离 data URI 前缀
-            parts = data.split(",", 1)
-            if len(parts) == 2:
-                data = parts[1]
+        if data.startswith("data:"):
+            comma = data.find(",", 0, 256)
+            if comma != -1:
+                data = data[comma + 1:]
         
         # 2. 清理可能的空白字符
-        data = data.replace(" ", "").replace("\n", "").replace("\r", "")
+        data = data.translate(_WS_TRANS)
+        
+        # 3. 解码 base64 数据（先快速检查开头部分，明显非法的数据直接拒绝）
+        if not _looks_like_base64(data):
+            return f"Base64 decode error: Invalid base64 characters. Data length: {len(data)}, First 50 chars: {data[:50]}"
         
-        # 3. 解码 base64 数据
         try:
-            image_bytes = base64.b64decode(data, validate=True)
+            if len(data) < _PYBASE64_MIN_LENGTH:
+                image_bytes = base64.b64decode(data, validate=True)
+            else:
+                # 大数据在工作线程中解码，避免阻塞事件循环
+                image_bytes = await asyncio.to_thread(pybase64.b64decode, data, validate=True)
         except Exception as decode_error:
             return f"Base64 decode error: {str(decode_error)}. Data length: {len(data)}, First 50 chars: {data[:50]}"
+        # 解码完成后释放清理过的 base64 字符串，降低上传期间的峰值内存
+        del data
         
         # 4. 验证解码后的数据不为空
-        if not image_bytes or len(image_bytes) == 0:
+        if not image_bytes:
             return "Decoded image data is empty"
+        image_size = len(image_bytes)
+        
+        # 5. 确定扩展名：PNG/JPEG 直接根据文件头识别，其余情况根据 content_type 决定
+        if image_bytes.startswith(_PNG_SIGNATURE):
+            ext, content_type = "png", "image/png"
+        elif image_bytes.startswith(_JPEG_SIGNATURE):
+            ext, content_type = "jpg", "image/jpeg"
+        else:
+            ext = content_type.split("/")[-1] if "/" in content_type else "png"
         
-        # 5. 生成文件名（确保有正确的扩展名）
+        # 6. 生成文件名（确保有正确的扩展名）
         if filename:
             object_name = filename
             # 确保文件名有扩展名
             if "." not in object_name:
-                ext = content_type.split("/")[-1] if "/" in content_type else "png"
                 object_name = f"{object_name}.{ext}"
         else:
-            # 根据 content_type 决定扩展名
-            ext = content_type.split("/")[-1] if "/" in content_type else "png"
             object_name = f"{uuid.uuid4().hex}.{ext}"
         
-        # 6. 上传到 MinIO
-        client.put_object(
+        # 7. 上传到 MinIO（BytesIO 直接共享 bytes 缓冲区，不会再复制一份）
+        #    分片大小不小于图片大小，使其以单次 PUT 上传，SDK 一次读出整个缓冲区而不按分片复制
+        await asyncio.to_thread(
+            client.put_object,
             BUCKET,
             object_name,
             io.BytesIO(image_bytes),
-            len(image_bytes),
-            content_type=content_type
+            image_size,
+            content_type=content_type,
+            part_size=max(image_size, _MIN_PART_SIZE)
         )
         
-        # 7. 返回公开访问 URL
-        public_url = f"{PUBLIC_BASE_URL}/{BUCKET}/{object_name}"
+        # 8. 返回公开访问 URL
+        public_url = _URL_PREFIX + object_name
         
         # 返回成功信息（简洁格式）
-        return f"✅ Image uploaded successfully!\nURL: {public_url}\nSize: {len(image_bytes)} bytes\nFilename: {object_name}"
+        return f"✅ Image uploaded successfully!\nURL: {public_url}\nSize: {image_size} bytes\nFilename: {object_name}"
     
     except Exception as e:
-        import traceback
-        error_detail = traceback.format_exc()
-        return f"❌ Upload failed: {str(e)}\n\nDetails:\n{error_detail}"
+        error_detail = f"\n\nDetails:\n{traceback.format_exc()}" if MCP_DEBUG else ""
+        return f"❌ Upload failed: {str(e)}{error_detail}"
 
 
 @mcp.tool()
-def upload_file(
+async def upload_file(
     file_path: str,
     target_filename: str = None,
     content_type: str = None
@@ -188,24 +340,23 @@ def upload_file(
     Supported file types: images, PDFs, text files, and more.
     """
     try:
-        import mimetypes
-        
         # 1. 验证文件路径
         if not file_path:
             return "❌ Error: file_path is required"
         
-        # 2. 检查文件是否存在
-        if not os.path.exists(file_path):
+        # 2. 检查文件是否存在（一次 stat 同时获取类型和大小）
+        try:
+            file_stat = os.stat(file_path)
+        except (OSError, ValueError):
             return f"❌ Error: File not found: {file_path}"
         
-        if not os.path.isfile(file_path):
+        if not stat.S_ISREG(file_stat.st_mode):
             return f"❌ Error: Path is not a file: {file_path}"
         
-        # 3. 读取文件内容
-        with open(file_path, 'rb') as f:
-            file_data = f.read()
+        # 3. 获取文件大小（文件内容在上传时流式读取）
+        file_size = file_stat.st_size
         
-        if not file_data or len(file_data) == 0:
+        if file_size <= 0:
             return f"❌ Error: File is empty: {file_path}"
         
         # 4. 确定文件名
@@ -222,31 +373,36 @@ def upload_file(
         # 5. 确定 content_type
         if not content_type:
             # 自动检测 MIME 类型
-            guessed_type, _ = mimetypes.guess_type(file_path)
-            content_type = guessed_type or "application/octet-stream"
+            content_type = _guess_content_type(os.path.splitext(file_path)[1].lower())
         
-        # 6. 上传到 MinIO
-        client.put_object(
-            BUCKET,
-            object_name,
-            io.BytesIO(file_data),
-            len(file_data),
-            content_type=content_type
-        )
+        # 6. 流式上传到 MinIO，避免把整个文件读入内存
+        #    提示内核按顺序预读
+        with open(file_path, 'rb') as f:
+            if hasattr(os, "posix_fadvise"):
+                # 仅为预读提示，失败时不影响上传
+                with contextlib.suppress(OSError):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            await asyncio.to_thread(
+                client.put_object,
+                BUCKET,
+                object_name,
+                f,
+                file_size,
+                content_type=content_type
+            )
         
         # 7. 返回公开访问 URL
-        public_url = f"{PUBLIC_BASE_URL}/{BUCKET}/{object_name}"
+        public_url = _URL_PREFIX + object_name
         
-        return f"✅ File uploaded successfully!\nURL: {public_url}\nSize: {len(file_data)} bytes\nFilename: {object_name}\nContent-Type: {content_type}"
+        return f"✅ File uploaded successfully!\nURL: {public_url}\nSize: {file_size} bytes\nFilename: {object_name}\nContent-Type: {content_type}"
     
     except Exception as e:
-        import traceback
-        error_detail = traceback.format_exc()
-        return f"❌ Upload failed: {str(e)}\n\nDetails:\n{error_detail}"
+        error_detail = f"\n\nDetails:\n{traceback.format_exc()}" if MCP_DEBUG else ""
+        return f"❌ Upload failed: {str(e)}{error_detail}"
 
 
 @mcp.tool()
-def list_files(prefix: str = "") -> str:
+async def list_files(prefix: str = "") -> str:
     """
     List files in the MinIO bucket.
     
@@ -263,29 +419,26 @@ def list_files(prefix: str = "") -> str:
         List of files with their sizes and URLs.
     """
     try:
-        objects = client.list_objects(BUCKET, prefix=prefix, recursive=True)
-        
-        files = []
-        for obj in objects:
-            url = f"{PUBLIC_BASE_URL}/{BUCKET}/{obj.object_name}"
-            size_kb = obj.size / 1024
-            files.append(f"- {obj.object_name} ({size_kb:.1f} KB)\n  URL: {url}")
+        # 在工作线程中遍历对象并直接生成每一行，不保留对象列表
+        files = await asyncio.to_thread(
+            lambda: [
+                f"- {obj.object_name} ({obj.size / 1024:.1f} KB)\n  URL: {_URL_PREFIX}{obj.object_name}"
+                for obj in client.list_objects(BUCKET, prefix=prefix, recursive=True)
+            ]
+        )
         
         if not files:
             return f"📁 Bucket '{BUCKET}' is empty" + (f" (prefix: {prefix})" if prefix else "")
         
-        result = f"📁 Files in bucket '{BUCKET}'" + (f" (prefix: {prefix})" if prefix else "") + f":\n\n"
-        result += "\n".join(files)
-        result += f"\n\nTotal: {len(files)} files"
-        
-        return result
+        header = f"📁 Files in bucket '{BUCKET}'" + (f" (prefix: {prefix})" if prefix else "")
+        return f"{header}:\n\n" + "\n".join(files) + f"\n\nTotal: {len(files)} files"
     
     except Exception as e:
         return f"❌ Error listing files: {str(e)}"
 
 
 @mcp.tool()
-def upload_from_url(
+async def upload_from_url(
     url: str,
     target_filename: str = None,
     content_type: str = None
@@ -318,9 +471,7 @@ def upload_from_url(
     Supported: Any downloadable file (images, PDFs, documents, etc.)
     """
     try:
-        import urllib.request
         import urllib.parse
-        import mimetypes
         
         # 1. 验证 URL
         if not url:
@@ -329,86 +480,101 @@ def upload_from_url(
         if not url.startswith(('http://', 'https://')):
             return f"❌ Error: Invalid URL format. Must start with http:// or https://. Got: {url}"
         
-        # 2. 下载文件
+        # 2. 打开下载连接（响应体在上传时流式读取，不整体读入内存）
         try:
-            # 创建请求，添加 User-Agent 避免被拒绝
-            request = urllib.request.Request(
-                url,
-                headers={
-                    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) MinIO-MCP/1.0'
-                }
-            )
-            
-            with urllib.request.urlopen(request, timeout=30) as response:
-                file_data = response.read()
-                
-                # 获取响应的 content-type
-                response_content_type = response.headers.get('Content-Type', '')
-                if response_content_type and ';' in response_content_type:
-                    response_content_type = response_content_type.split(';')[0].strip()
-                
-        except urllib.error.HTTPError as e:
-            return f"❌ HTTP Error: {e.code} {e.reason} for URL: {url}"
-        except urllib.error.URLError as e:
-            return f"❌ URL Error: {str(e.reason)} for URL: {url}"
+            response = await _http.send(_http.build_request("GET", url), stream=True)
+        except httpx.RequestError as e:
+            return f"❌ URL Error: {str(e)} for URL: {url}"
         except Exception as e:
             return f"❌ Download failed: {str(e)}"
         
-        # 3. 验证下载的数据
-        if not file_data or len(file_data) == 0:
-            return f"❌ Error: Downloaded file is empty from URL: {url}"
-        
-        # 4. 确定文件名
-        if target_filename:
-            object_name = target_filename
-        else:
-            # 从 URL 提取文件名
-            parsed_url = urllib.parse.urlparse(url)
-            path = parsed_url.path
-            object_name = os.path.basename(path)
+        async with contextlib.aclosing(response):
+            if not response.is_success:
+                # 服务器可能不返回 reason phrase，回退到标准状态码描述
+                reason = response.reason_phrase or httpx.codes.get_reason_phrase(response.status_code)
+                status = f"{response.status_code} {reason}" if reason else str(response.status_code)
+                return f"❌ HTTP Error: {status} for URL: {url}"
+            
+            # 获取响应的 content-type
+            response_content_type = response.headers.get('Content-Type', '')
+            if response_content_type and ';' in response_content_type:
+                response_content_type = response_content_type.split(';')[0].strip()
+            
+            # 获取响应长度，未知时为 -1
+            content_length = response.headers.get('Content-Length', '')
+            content_length = int(content_length) if content_length.isdigit() else -1
+            
+            reader = _StreamReader(response.aiter_raw(65536), asyncio.get_running_loop())
             
-            # 如果没有文件名，生成一个
-            if not object_name or object_name == '':
+            # 3. 验证下载的数据
+            if content_length == 0 or (content_length < 0 and not await reader.has_data()):
+                return f"❌ Error: Downloaded file is empty from URL: {url}"
+            
+            # 4. 确定文件名
+            if target_filename:
+                object_name = target_filename
+            else:
+                # 从 URL 提取文件名
+                parsed_url = urllib.parse.urlparse(url)
+                path = parsed_url.path
+                object_name = os.path.basename(path)
+                
+                # 如果没有文件名，生成一个
+                if not object_name or object_name == '':
+                    ext = mimetypes.guess_extension(response_content_type) or '.bin'
+                    object_name = f"{uuid.uuid4().hex}{ext}"
+            
+            # 确保有扩展名
+            if "." not in object_name:
                 ext = mimetypes.guess_extension(response_content_type) or '.bin'
-                object_name = f"{uuid.uuid4().hex}{ext}"
-        
-        # 确保有扩展名
-        if "." not in object_name:
-            ext = mimetypes.guess_extension(response_content_type) or '.bin'
-            object_name = f"{object_name}{ext}"
-        
-        # 5. 确定 content_type
-        if not content_type:
-            if response_content_type:
-                content_type = response_content_type
+                object_name = f"{object_name}{ext}"
+            
+            # 5. 确定 content_type
+            if not content_type:
+                if response_content_type:
+                    content_type = response_content_type
+                else:
+                    content_type = _guess_content_type(os.path.splitext(object_name)[1].lower())
+            
+            # 6. 将响应流直接上传到 MinIO
+            if content_length >= 0:
+                await asyncio.to_thread(
+                    client.put_object,
+                    BUCKET,
+                    object_name,
+                    reader,
+                    content_length,
+                    content_type=content_type,
+                    part_size=_part_size_for(content_length)
+                )
+                file_size = content_length
             else:
-                guessed_type, _ = mimetypes.guess_type(object_name)
-                content_type = guessed_type or "application/octet-stream"
-        
-        # 6. 上传到 MinIO
-        client.put_object(
-            BUCKET,
-            object_name,
-            io.BytesIO(file_data),
-            len(file_data),
-            content_type=content_type
-        )
+                # 长度未知时走 MinIO 的分片上传
+                await asyncio.to_thread(
+                    client.put_object,
+                    BUCKET,
+                    object_name,
+                    reader,
+                    -1,
+                    content_type=content_type,
+                    part_size=_UNKNOWN_LENGTH_PART_SIZE
+                )
+                file_size = reader.bytes_read
         
         # 7. 返回公开访问 URL
-        public_url = f"{PUBLIC_BASE_URL}/{BUCKET}/{object_name}"
+        public_url = _URL_PREFIX + object_name
         
-        return f"✅ File uploaded from URL successfully!\nSource: {url}\nMinIO URL: {public_url}\nSize: {len(file_data)} bytes\nFilename: {object_name}\nContent-Type: {content_type}"
+        return f"✅ File uploaded from URL successfully!\nSource: {url}\nMinIO URL: {public_url}\nSize: {file_size} bytes\nFilename: {object_name}\nContent-Type: {content_type}"
     
     except Exception as e:
-        import traceback
-        error_detail = traceback.format_exc()
-        return f"❌ Upload from URL failed: {str(e)}\n\nDetails:\n{error_detail}"
+        error_detail = f"\n\nDetails:\n{traceback.format_exc()}" if MCP_DEBUG else ""
+        return f"❌ Upload from URL failed: {str(e)}{error_detail}"
 
 
 @mcp.tool()
 def generate_random_string(length: int = 16) -> str:
     """
-    Generate a random string using UUID.
+    Generate a random hexadecimal string.
     
     USE THIS TOOL WHEN:
     - You need a unique identifier for filenames
@@ -444,7 +610,7 @@ def generate_random_string(length: int = 16) -> str:
             return "❌ Error: length cannot exceed 32"
         
         # 生成随机字符串
-        random_string = uuid.uuid4().hex[:length]
+        random_string = secrets.token_hex((length + 1) // 2)[:length]
         
         return f"✅ Random string generated: {random_string}"
     